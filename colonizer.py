@@ -5,9 +5,10 @@ import json
 from time import time
 import heapq
 import csv
+from collections import deque
 
 from display import print_as_grid
-from generalsio import Tile, GameClient, GameClientListener
+from generalsio import Tile, GameClient, GameClientListener, CONNECTION_ERRORS
 from world import World as BasicWorld
 
 segment_times = {}
@@ -21,11 +22,47 @@ def time_segment(segment_name, start_time):
 def tot_times_sans_outliers():
     return {name: sum([time for time in times if time < 1]) for name, times in segment_times.items()}
 
+# Map sizes to prebuild structures for while waiting in queue, on top of any sizes already played
+WARM_MAP_SIZES = [(width, height) for width in range(18, 24) for height in range(18, 24)]
+
+neighbor_tables = {}
+def neighbor_table(map_width, map_height):
+    '''
+    In-bounds neighbors of every tile, in the same [right, up, left, down] order as cardinal_translations.
+    Cached per map size so that it can be built ahead of time and shared across games.
+    '''
+    if (map_width, map_height) not in neighbor_tables:
+        tile_count = map_width * map_height
+        neighbor_tables[(map_width, map_height)] = [[n for n in (
+            None if i % map_width == map_width - 1 else i + 1,
+            None if i < map_width else i - map_width,
+            None if i % map_width == 0 else i - 1,
+            None if i >= tile_count - map_width else i + map_width) if n is not None]
+            for i in range(tile_count)]
+    return neighbor_tables[(map_width, map_height)]
+
+def path_moves(path):
+    return [(path[i], path[i+1]) for i in range(len(path)-1)]
+
 class World(BasicWorld):
     def __init__(self, map_width, map_height, player_index, game_start_data):
         super().__init__(map_width, map_height, player_index, game_start_data)
         self.capital_distances = None
         self.movement_finished_turn = 24
+        self.neighbor_table = neighbor_table(map_width, map_height)
+        # Everything below depends only on the map size and is reused for the whole game,
+        # so a World can be built while waiting in queue (see Bot.handle_queue_wait).
+        tile_count = map_width * map_height
+        self.distance_buffer = [Tile.EMPTY] * tile_count
+        # Frontier index: unowned reachable tiles bucketed by capital distance, each bucket with a
+        # lazily invalidated min-heap of its tiles, and a lazily invalidated max-heap of (-army, tile) for owned tiles.
+        # No capital distance reaches tile_count, so that many buckets always suffices.
+        self.unowned_by_distance = [set() for _ in range(tile_count)]
+        self.unowned_heaps = [[] for _ in range(tile_count)]
+        self.furthest_distance = -1 # No bucket past this one has tiles
+        self.owned_army_heap = []
+        # Unowned passable tiles next to owned land
+        self.frontier = set()
 
     def cardinal_translations(self):
         right = lambda start: None if start % self.map_width == self.map_width - 1 else start + 1
@@ -34,10 +71,96 @@ class World(BasicWorld):
         down = lambda start: None if start > self.map_width * (self.map_height - 1) - 1 else start + self.map_width
         return [right, up, left, down]
 
-    def update(self, terrain, armies, cities, generals, turn, scores):
+    def update(self, terrain, armies, cities, generals, turn, scores, changed_tiles=None):
+        previous_terrain = self.terrain
         super().update(terrain, armies, cities, generals, turn, scores)
-        # Improve: Only do this when new information warrants it (city found)
-        self.capital_distances = self.calculate_distances(self.generals[self.player_index])
+        if changed_tiles is None or previous_terrain is None or any(
+                self.terrain[i] != previous_terrain[i] and self.is_obstacle(i) != (previous_terrain[i] in (Tile.UNKNOWN_OBSTACLE, Tile.MOUNTAIN))
+                for i in changed_tiles):
+            # Distances only change when an obstacle is found or turns out not to be one
+            self.capital_distances = self.calculate_distances(self.generals[self.player_index], distances=self.distance_buffer)
+            self.rebuild_frontier_index()
+        else:
+            for i in changed_tiles:
+                self.index_tile(i)
+            # A tile's frontier membership also depends on who owns its neighbors
+            for i in {n for i in changed_tiles for n in [i, *self.neighbor_table[i]]}:
+                self.index_frontier(i)
+
+    def rebuild_frontier_index(self):
+        for distance in range(self.furthest_distance + 1):
+            self.unowned_by_distance[distance].clear()
+            self.unowned_heaps[distance].clear()
+        self.furthest_distance = -1
+        self.owned_army_heap.clear()
+        self.frontier.clear()
+        for i in range(len(self.terrain)):
+            self.index_tile(i)
+            self.index_frontier(i)
+
+    def index_frontier(self, loc):
+        if self.terrain[loc] != self.player_index and not self.is_obstacle(loc) and \
+                any(self.terrain[n] == self.player_index for n in self.neighbor_table[loc]):
+            self.frontier.add(loc)
+        else:
+            self.frontier.discard(loc)
+
+    def index_tile(self, loc):
+        distance = self.capital_distances[loc]
+        if self.terrain[loc] == self.player_index:
+            heapq.heappush(self.owned_army_heap, (-self.armies[loc], loc))
+            if distance >= 0:
+                self.unowned_by_distance[distance].discard(loc)
+        elif distance >= 0:
+            self.furthest_distance = max(self.furthest_distance, distance)
+            bucket, heap = self.unowned_by_distance[distance], self.unowned_heaps[distance]
+            if loc not in bucket:
+                bucket.add(loc)
+                heapq.heappush(heap, loc)
+                if len(heap) > 2 * len(bucket):
+                    heap[:] = sorted(bucket)
+        if len(self.owned_army_heap) > 2 * len(self.terrain):
+            # Drop the stale entries once they outnumber the tiles
+            self.owned_army_heap = [(-army, i) for i, army in enumerate(self.armies) if self.terrain[i] == self.player_index]
+            heapq.heapify(self.owned_army_heap)
+
+    def furthest_unowned(self):
+        '''Reachable tile furthest from the capital that isn't owned, or None if all reachable land is owned.'''
+        while self.furthest_distance >= 0 and not self.unowned_by_distance[self.furthest_distance]:
+            self.furthest_distance -= 1
+        if self.furthest_distance < 0:
+            return None
+        bucket, heap = self.unowned_by_distance[self.furthest_distance], self.unowned_heaps[self.furthest_distance]
+        while heap[0] not in bucket:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def frontier_near(self, loc, k):
+        '''
+        Up to |k| frontier tiles (unowned tiles next to owned land), nearest to |loc| by walking distance first.
+        Searches outward from |loc| and stops as soon as it has |k| of them.
+        '''
+        found = []
+        seen = {loc}
+        spots_to_check = deque([loc])
+        while len(spots_to_check) > 0 and len(found) < k:
+            current = spots_to_check.popleft()
+            if current in self.frontier:
+                found.append(current)
+            for new_spot in self.neighbor_table[current]:
+                if new_spot not in seen and not self.is_obstacle(new_spot):
+                    seen.add(new_spot)
+                    spots_to_check.append(new_spot)
+        return found
+
+    def largest_owned_army(self):
+        '''Owned tile with the largest army (lowest index on ties).'''
+        while len(self.owned_army_heap):
+            negative_army, loc = self.owned_army_heap[0]
+            if self.terrain[loc] == self.player_index and self.armies[loc] == -negative_army:
+                return loc
+            heapq.heappop(self.owned_army_heap)
+        return None
 
     def capital_location(self):
         return self.generals[self.player_index]
@@ -53,17 +176,19 @@ class World(BasicWorld):
             obstacle_fn = lambda i: self.is_obstacle(i)
         return [Tile.UNKNOWN_OBSTACLE if obstacle_fn(i) else Tile.EMPTY for i in range(len(self.terrain))]
 
-    def calculate_distances(self, reference_point, obstacle_fn=None):
+    def calculate_distances(self, reference_point, obstacle_fn=None, distances=None):
         # print(f'calculate_distances({reference_point}); terrain:')
         # print_as_grid(terrain, width=map_width, tile_aliases={**DEFAULT_GRID_ALIASES, -5:'*'})
-        distances = self.obstacle_view(obstacle_fn)
+        if distances is None:
+            distances = self.obstacle_view(obstacle_fn)
+        else:
+            distances[:] = self.obstacle_view(obstacle_fn)
         distances[reference_point] = 0; # 0 distance
         spots_to_check = [reference_point]
         while len(spots_to_check) > 0:
             current = spots_to_check.pop(0)
-            for translation in self.cardinal_translations():
-                new_spot = translation(current)
-                if new_spot != None and distances[new_spot] == Tile.EMPTY:
+            for new_spot in self.neighbor_table[current]:
+                if distances[new_spot] == Tile.EMPTY:
                     distances[new_spot] = distances[current] + 1
                     spots_to_check.append(new_spot)
         return distances
@@ -77,7 +202,7 @@ class World(BasicWorld):
         while current != dest:
             # print(f'pathing over {current}')
             # Choose the step that results in the least remaining distance to destination
-            next_step = [t(current) for t in self.cardinal_translations() if t(current) is not None and dest_distances[t(current)] != Tile.UNKNOWN_OBSTACLE]
+            next_step = [n for n in self.neighbor_table[current] if dest_distances[n] != Tile.UNKNOWN_OBSTACLE]
             next_step.sort(key=lambda a: dest_distances[a])
             next_step = next_step[0]
             path.append(next_step)
@@ -95,9 +220,23 @@ class Bot(GameClientListener, GameClient):
     def __init__(self, game_id, user_id):
         super().__init__(game_id, user_id)
         self.add_listener(self)
+        self.map_sizes_played = set()
+        self.prepared_worlds = {}
+
+    def handle_queue_wait(self):
+        # Build the per-map-size parts of World (neighbor tables, distance buffer, index buckets) ahead of time.
+        # The opening search on the first update needs the terrain, so it still runs cold.
+        for map_size in [*self.map_sizes_played, *WARM_MAP_SIZES]:
+            if map_size not in self.prepared_worlds:
+                self.prepared_worlds[map_size] = World(*map_size, None, None)
 
     def handle_game_start(self, map_size, player_index, game_start_data):
-        self.world = World(map_size[0], map_size[1], player_index, game_start_data)
+        self.map_sizes_played.add(tuple(map_size))
+        self.world = self.prepared_worlds.pop(tuple(map_size), None)
+        if self.world is None:
+            self.world = World(map_size[0], map_size[1], player_index, game_start_data)
+        self.world.player_index = player_index
+        self.world.game_start_data = game_start_data
 
     def traverse(self, start, end):
         # print(f'Traversal requested from {start} to {end}')
@@ -112,17 +251,16 @@ class Bot(GameClientListener, GameClient):
                 # print(f'Insufficient armies to travel from {start} to {end} ({len(original_path) - 1} tiles).' +
                 #     f'Travelling {len(path) - 1} tiles to {path[-1]} instead.')
             # print(f'Moves queued: {path}')
-            for i in range(len(path)-1):
-                # print(f'queueing move: ${path[i]} to ${path[i+1]}')
-                self.attack(path[i], path[i+1])
+            # Replaces whatever is left of a stale path; only the changed moves are emitted.
+            self.set_move_queue(path_moves(path))
             return path
         else:
             print(f'traversal failed. terrain[{start}] = {self.world.terrain[start]} != {self.world.player_index}')
             # print_as_grid(terrain, width=map_width)
 
-    def handle_game_update(self, terrain, armies, cities, generals, half_turns, scores):
+    def handle_game_update(self, terrain, armies, cities, generals, half_turns, scores, changed_tiles=None):
         # update_start_time = time()
-        self.world.update(terrain, armies, cities, generals, half_turns, scores)
+        self.world.update(terrain, armies, cities, generals, half_turns, scores, changed_tiles)
         # TODO: Remember cities
         # TODO: Remember general locations
 
@@ -136,22 +274,17 @@ class Bot(GameClientListener, GameClient):
             if len(self.world.expansion_plan) > 0:
                 if half_turns//2 == self.world.expansion_plan[0]['turn']:
                     path = self.world.expansion_plan[0]['path']
-                    for i in range(len(path)-1):
-                        self.attack(path[i], path[i+1])
+                    self.set_move_queue(self.pending_moves() + path_moves(path))
                     self.world.expansion_plan = self.world.expansion_plan[1:]
         else:
-            del self._sock
             if self.world.turn >= self.world.movement_finished_turn:
-                unowned_territory_distances = [-5 if terrain[i] == self.world.player_index else tile for i, tile in enumerate(self.world.capital_distances)]
-                # print("unowned_territory_distances:")
-                # print_as_grid(unowned_territory_distances, width=map_width, tile_aliases={**DEFAULT_GRID_ALIASES, -5:'*'})
-                furthest_unexplored_loc = unowned_territory_distances.index(max(unowned_territory_distances))
-                army_sizes = [army if terrain[i] == self.world.player_index else 0 for i, army in enumerate(armies)]
-                largest_army_loc = army_sizes.index(max(army_sizes))
-                path = self.traverse(largest_army_loc, furthest_unexplored_loc)
-                # print('cities: ', cities)
-                # print_path(path)
-                self.world.movement_finished_turn = len(path) - 1 + self.world.turn
+                furthest_unexplored_loc = self.world.furthest_unowned()
+                largest_army_loc = self.world.largest_owned_army()
+                if furthest_unexplored_loc is not None:
+                    path = self.traverse(largest_army_loc, furthest_unexplored_loc)
+                    # print('cities: ', cities)
+                    # print_path(path)
+                    self.world.movement_finished_turn = len(path) - 1 + self.world.turn
         # self.world.print_map()
 
 
@@ -164,6 +297,10 @@ class Bot(GameClientListener, GameClient):
             header = 'Game Lost'
         print(header)
         print('='*len(header))
+        if self.first_update_latency is not None:
+            print(f'First update handled {round(self.first_update_latency, 2)}s after game start')
+        if len(self.move_latencies):
+            print(f'Move latency: mean {round(mean(self.move_latencies), 2)}s, max {round(max(self.move_latencies), 2)}s over {len(self.move_latencies)} moves')
         print('Replay: %s\n' % replay_url)
 
     def handle_chat(self, username, message):
@@ -215,10 +352,8 @@ class Bot(GameClientListener, GameClient):
         # IMPROVE: Consider whether we may want to terminate a path early sometimes?
         capital = self.world.capital_location()
         origin = current_clear['path'][-1] if len(current_clear['path']) < current_clear['move_cap'] else capital
-        for translation in self.world.cardinal_translations():
-            destination = translation(origin)
-            if destination is not None and \
-                    board[destination] != Tile.UNKNOWN_OBSTACLE and \
+        for destination in self.world.neighbor_table[origin]:
+            if board[destination] != Tile.UNKNOWN_OBSTACLE and \
                     (origin == capital or
                     (destination not in current_clear['path'] and destination != capital)):  # No pathing over this current path
                 moves.append((origin, destination))
@@ -331,19 +466,34 @@ def main():
 
     user_id = None if user_config is None else user_config['user_id']
 
-    while True:
+    def reconnect(previous_bot):
+        # Module-level caches like neighbor_tables survive; carry over what the bot learned too
         bot = Bot(game_id, user_id)
+        bot.map_sizes_played = previous_bot.map_sizes_played
+        return bot
 
-        if game_id == '1v1':
-            bot.join_1v1_queue()
-        elif game_id == 'ffa':
-            bot.join_ffa_queue()
-        else:
-            bot.join_custom(game_id, force_start_delay=2)
+    # One connection for the whole session; the bot re-queues after each game.
+    bot = Bot(game_id, user_id)
+    while True:
         try:
+            if game_id == '1v1':
+                bot.join_1v1_queue()
+            elif game_id == 'ffa':
+                bot.join_ffa_queue()
+            else:
+                bot.join_custom(game_id, force_start_delay=2)
             bot.wait_for_game_end()
+        except CONNECTION_ERRORS as err:
+            print(f'Connection lost ({err}). Reconnecting.')
+            bot = reconnect(bot)
         except Exception as err:
             print(err)
+            # The game may still be running; leave it before queueing again on the same connection
+            try:
+                bot.leave_game()
+            except CONNECTION_ERRORS as err:
+                print(f'Connection lost ({err}). Reconnecting.')
+                bot = reconnect(bot)
 
 
 if __name__ == '__main__':
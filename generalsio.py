@@ -3,6 +3,10 @@ from string import ascii_letters
 from time import time
 from urllib.parse import quote
 from socketIO_client import SocketIO, BaseNamespace
+from socketIO_client.exceptions import SocketIOError
+
+# Errors meaning the connection itself is gone, so the client has to be rebuilt
+CONNECTION_ERRORS = (SocketIOError, OSError)
 
 # Terrain Constants.
 # Any tile with a nonnegative value is owned by the player corresponding to its value.
@@ -15,7 +19,8 @@ class Tile(object):
 
 
 class GameClientListener(object):
-    def handle_game_update(self, terrain, armies, cities, generals, half_turns, scores):
+    def handle_game_update(self, terrain, armies, cities, generals, half_turns, scores, changed_tiles=None):
+        '''|changed_tiles| is the set of tiles whose army or terrain changed, or None if unknown.'''
         pass
 
     def handle_game_start(self, map_size, player_index, game_Start_data):
@@ -24,6 +29,10 @@ class GameClientListener(object):
     def handle_game_over(self, won, replay_url):
         pass
 
+    def handle_queue_wait(self):
+        '''Called after joining a queue or lobby, while waiting for the game to start.'''
+        pass
+
     def handle_chat(self, username, message):
         pass
 
@@ -59,6 +68,16 @@ class GameClient(object):
         self.game_started = False
         self._map = []
         self._cities = []
+        # Seconds from game_start until the first update has been handled, or a move was emitted while handling it
+        self.first_update_latency = None
+        self._game_start_time = None
+
+        # Mirror of the server-side move queue: [{'start', 'end', 'half_move', 'emitted_at'}, ...]
+        self._move_queue = []
+        self._prev_terrain = None
+        self._prev_armies = None
+        # Seconds between emitting each move and seeing it executed in a game_update
+        self.move_latencies = []
 
         self._listeners = []
         self._chat_room = None
@@ -75,17 +94,23 @@ class GameClient(object):
         self._sock.emit('set_username', self._user_id, username)
 
     def join_1v1_queue(self):
+        self._reset_game()
         self._sock.emit('join_1v1', self._user_id)
         print('Joined 1v1 queue')
+        self._on_queue_wait()
 
     def join_ffa_queue(self):
+        self._reset_game()
         self._sock.emit('play', self._user_id)
         print('Joined ffa queue')
+        self._on_queue_wait()
 
     def join_custom(self, game_id, force_start_delay=5):
+        self._reset_game()
         self._sock.emit('join_private', game_id, self._user_id)
         print('Joined custom game at http://bot.generals.io/games/' + quote(game_id))
         join_time = time()
+        self._on_queue_wait()
         while not self.game_started:
             if time() - join_time > force_start_delay:
                 self.set_force_start(game_id)
@@ -99,11 +124,41 @@ class GameClient(object):
         self._sock.emit('chat_message', self._chat_room, message)
 
     def attack(self, start, end, half_move=False):
+        if self.first_update_latency is None and self._game_start_time is not None:
+            self.first_update_latency = time() - self._game_start_time
+        self._move_queue.append({'start': start, 'end': end, 'half_move': half_move, 'emitted_at': time()})
         self._sock.emit('attack', start, end, half_move)
 
     def clear_moves(self):
+        self._move_queue = []
         self._sock.emit('clear_moves')
 
+    def pending_moves(self):
+        '''
+        Moves believed to still be queued on the server, oldest first, as (start, end, half_move) tuples.
+        '''
+        return [(move['start'], move['end'], move['half_move']) for move in self._move_queue]
+
+    def set_move_queue(self, moves):
+        '''
+        Make the server-side queue match |moves| while emitting as little as possible.
+        |moves| is a list of (start, end) or (start, end, half_move) tuples.
+        The server only supports appending and clearing, so if the queue we believe it has
+        is a prefix of |moves| only the remainder is emitted; otherwise it is cleared and re-sent.
+        Returns the number of emits sent.
+        '''
+        desired = [(move[0], move[1], move[2] if len(move) > 2 else False) for move in moves]
+        pending = self.pending_moves()
+        emits = 0
+        if desired[:len(pending)] != pending:
+            self.clear_moves()
+            pending = []
+            emits += 1
+        for start, end, half_move in desired[len(pending):]:
+            self.attack(start, end, half_move)
+            emits += 1
+        return emits
+
     def add_listener(self, listener):
         assert isinstance(listener, GameClientListener)
         self._listeners.append(listener)
@@ -111,9 +166,27 @@ class GameClient(object):
     def wait(self, seconds=None):
         self._sock.wait(seconds)
 
+    def leave_game(self):
+        '''Leave the current game, even mid-game, so that another can be joined.'''
+        self._leave_game()
+        self._reset_game()
+
     def _leave_game(self):
-        # self._sock.emit('leave_game')
-        del self._sock
+        # Stay connected so the next game can be joined on the same socket
+        self._sock.emit('leave_game')
+
+    def _reset_game(self):
+        self.game_over = False
+        self.game_started = False
+        self._is_first_update = True
+        self._map = []
+        self._cities = []
+        self._move_queue = []
+        self._prev_terrain = self._prev_armies = None
+
+    def _on_queue_wait(self):
+        for listener in self._listeners:
+            listener.handle_queue_wait()
 
     def _on_game_won(self, data, _):
         self.game_over = True
@@ -151,7 +224,12 @@ class GameClient(object):
             'lights': []
         }
         """
+        self._game_start_time = time()
+        self.first_update_latency = None
         self._chat_room = data['chat_room']
+        self._move_queue = []
+        self._prev_terrain = self._prev_armies = None
+        self.move_latencies = []
         self.game_started = True
         self._is_first_update = True
         self._game_Start_data = data
@@ -177,7 +255,11 @@ class GameClient(object):
             'cities_diff': [ 1 ]
         }
         """
+        if not self.game_started:
+            # Stragglers from a game we already left; the diff can't be applied to the reset map
+            return
         self._processing_update = True
+        first_update = self._is_first_update
         self._map = _patch(self._map, data['map_diff'])
         self._cities = _patch(self._cities, data['cities_diff'])
 
@@ -194,7 +276,10 @@ class GameClient(object):
         armies = self._map[2:2 + tile_count]
         # The last |tile_count| terms are terrain values; terrain[0] is the top-left corner of the map.
         terrain = self._map[2 + tile_count:2 + tile_count*2]
+        # Map indices past the width and height wrap around from armies into terrain
+        changed_tiles = None if first_update else {(i - 2) % tile_count for i in _diff_indices(data['map_diff']) if i >= 2}
 
+        self._advance_move_queue(terrain, armies, data['generals'], data['turn'])
 
         # After game over, we will get 1 update with all land visible and the winner owning all captured land
         # Don't run custom update logic on this.
@@ -206,11 +291,44 @@ class GameClient(object):
                     cities=self._cities,
                     generals=data['generals'],
                     half_turns=data['turn'],
-                    scores=data['scores']
+                    scores=data['scores'],
+                    changed_tiles=changed_tiles
                 )
+            if first_update and self.first_update_latency is None:
+                self.first_update_latency = time() - self._game_start_time
 
         self._processing_update = False
 
+    def _advance_move_queue(self, terrain, armies, generals, half_turns):
+        '''
+        Pop the moves from the queue mirror that the server consumed this update.
+        The server skips queued moves that are invalid (start tile not ours or without
+        a movable army) and then executes at most one valid move per player per update.
+        '''
+        prev_terrain, prev_armies = self._prev_terrain, self._prev_armies
+        self._prev_terrain, self._prev_armies = terrain, armies
+        if prev_terrain is None:
+            return
+        while len(self._move_queue) > 0:
+            move = self._move_queue[0]
+            start = move['start']
+            # Also drop moves whose start tile was taken; we can't tell whether they ran first.
+            if prev_terrain[start] != self._player_index or prev_armies[start] <= 1 or terrain[start] != self._player_index:
+                self._move_queue.pop(0)
+                continue
+            # Generals and cities grow every turn, and all land grows every 25 turns.
+            growth = 0
+            if half_turns % 2 == 0 and (start in generals or start in self._cities):
+                growth += 1
+            if half_turns % 50 == 0:
+                growth += 1
+            # A move leaves 1 army behind (or half on a half move).
+            remaining = (prev_armies[start] + 1) // 2 if move['half_move'] else 1
+            if armies[start] < prev_armies[start] + growth and armies[start] <= remaining + growth:
+                self._move_queue.pop(0)
+                self.move_latencies.append(time() - move['emitted_at'])
+            break
+
     def _on_chat_message(self, chat_queue, data):
         if 'username' in data:
             username = data['username']
@@ -250,3 +368,21 @@ def _patch(old, diff):
             cursor += diff[cursor]
         cursor+=1
     return out
+
+def _diff_indices(diff):
+    '''
+    Returns the indices of the elements that patching |diff| replaces, without building the patched array.
+    Example: a diff of [1, 1, 3] replaces index 1.
+    '''
+    indices = []
+    position = 0
+    cursor = 0
+    while cursor < len(diff):
+        position += diff[cursor]  # matching
+        cursor+=1
+        if cursor < len(diff) and diff[cursor]:  # mismatching
+            indices.extend(range(position, position + diff[cursor]))
+            position += diff[cursor]
+            cursor += diff[cursor]
+        cursor+=1
+    return indices
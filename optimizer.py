@@ -0,0 +1,370 @@
+'''
+Offline expansion optimizer.
+
+Extends the clear-based model used by Bot.search_for_solution past turn 25. The first 25
+turns are planned by the live opening search itself; from there armies are launched from
+the capital and walked over the map one tile per half-turn, the capital gains 1 army per
+turn and every owned tile gains 1 army every 25 turns. Since this is far
+too slow to run live, it is run over a seeded corpus of generated maps on a process pool,
+writing the best plan found for each map (in the same clear format as plan_optimal_moveset)
+along with its land-by-turn curve.
+
+Usage:
+    python optimizer.py [--maps 32] [--turns 150] [--beam-width 2000] [--workers N] [--out DIR]
+
+Results are written one file per map as they finish, so an interrupted run resumes where it
+left off when restarted with the same --out directory.
+'''
+import argparse
+import csv
+import heapq
+import json
+import os
+import random
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+
+from colonizer import Bot, World
+from generalsio import Tile
+
+MAX_TURNS = 150
+OPENING_TURNS = 25 # horizon of Bot.search_for_solution
+ARMY_GROWTH_INTERVAL = 25 # turns between every owned tile gaining 1 army
+
+
+def generate_map(seed, min_size=18, max_size=23, mountain_density=0.2, city_density=0.03):
+    '''
+    Returns a World for a randomly generated single-player map.
+    Cities are treated as mountains, the same way search_for_solution treats them as obstacles.
+    '''
+    rng = random.Random(seed)
+    while True:
+        width = rng.randint(min_size, max_size)
+        height = rng.randint(min_size, max_size)
+        terrain = [Tile.MOUNTAIN if rng.random() < mountain_density + city_density else Tile.EMPTY for _ in range(width * height)]
+        open_tiles = [i for i, tile in enumerate(terrain) if tile == Tile.EMPTY]
+        capital = rng.choice(open_tiles)
+        world = World(width, height, 0, {'usernames': ['[Bot] Optimizer']})
+        terrain[capital] = 0
+        world.update(terrain, [1 if i == capital else 0 for i in range(len(terrain))], [], [capital], 1,
+                     [{'total': 1, 'tiles': 1, 'i': 0, 'color': 0, 'dead': False}])
+        reachable = [d for d in world.capital_distances if d >= 0]
+        # Reject maps where the capital is boxed into a small pocket
+        if len(reachable) >= len(open_tiles) // 2:
+            return world
+
+
+def passable_neighbor_table(world):
+    '''Passable neighbors of every tile, computed once instead of per expansion.'''
+    return [[] if world.is_obstacle(i) else [n for n in neighbors if not world.is_obstacle(n)]
+            for i, neighbors in enumerate(world.neighbor_table)]
+
+
+def zobrist(tile, army):
+    return hash((tile, army))
+
+
+def full_hash(armies):
+    h = 0
+    for tile, army in enumerate(armies):
+        if army:
+            h ^= zobrist(tile, army)
+    return h
+
+
+def apply_growth(armies, capital, half_turn):
+    '''
+    Army growth at the end of |half_turn|.
+    Returns True if all owned land grew, rather than at most the capital.
+    '''
+    if half_turn % 2:
+        return False
+    armies[capital] += 1
+    if half_turn % (2 * ARMY_GROWTH_INTERVAL) == 0:
+        for tile, army in enumerate(armies):
+            if army:
+                armies[tile] = army + 1
+        return True
+    return False
+
+
+class OpeningPlanner(Bot):
+    '''Runs the live opening search on a generated map, without a connection and without saving solutions.'''
+    def __init__(self, world):
+        self.world = world
+        self._replay_url = ''
+
+    def save_solutions(self, board, solutions, file_name):
+        pass
+
+
+def apply_move(armies, start, end):
+    '''Moves all but 1 army from |start| to |end|. Returns True if |end| is newly owned.'''
+    gained = not armies[end]
+    armies[end] += armies[start] - 1
+    armies[start] = 1
+    return gained
+
+
+class BeamSearch(object):
+    '''
+    Beam search over half-turns. A state is the army on every tile (owned iff nonzero, so the
+    array alone encodes the land) plus the tile holding the army currently being walked.
+    Each half-turn a state can continue walking that army, launch a new one from the capital
+    or wait. Candidates are deduplicated by an incrementally updated Zobrist hash and only
+    the |beam_width| survivors have their army arrays copied.
+    '''
+    def __init__(self, world, turns, beam_width):
+        self.capital = world.capital_location()
+        self.neighbors = passable_neighbor_table(world)
+        self.tile_count = len(self.neighbors)
+        self.half_turns = turns * 2
+        self.beam_width = beam_width
+
+    def opening_end(self, opening):
+        '''Last half-turn played by |opening|, or 1 if there is none.'''
+        return min(self.half_turns, 2 * OPENING_TURNS) if len(opening) else 1
+
+    def initial_state(self, opening=()):
+        '''
+        State at the end of the opening, played from the clears returned by plan_optimal_moveset.
+        Each clear starts once the capital can move on or after its turn, and is cut short if a
+        step can't move (its last steps may run onto land that's already owned).
+        '''
+        armies = array('H', [0] * self.tile_count)
+        armies[self.capital] = 1
+        land = 1
+        plan = None
+        clears = [{'turn': clear['turn'], 'steps': list(zip(clear['path'], clear['path'][1:]))} for clear in opening]
+        started = False
+        for half_turn in range(2, self.opening_end(opening) + 1):
+            while len(clears) and not len(clears[0]['steps']):
+                clears.pop(0)
+            # A clear is emitted on the update of its turn, so it can first move on the following half-turn
+            if len(clears) and (started or half_turn > 2 * clears[0]['turn']):
+                start, end = clears[0]['steps'][0]
+                if armies[start] > 1:
+                    clears[0]['steps'].pop(0)
+                    land += apply_move(armies, start, end)
+                    plan = ((half_turn, start, end), plan)
+                    started = True
+                elif started:
+                    clears[0]['steps'] = []
+                if not len(clears[0]['steps']):
+                    started = False
+            apply_growth(armies, self.capital, half_turn)
+        # (armies, active tile, hash, land, plan) where plan is a linked list of (half_turn, start, end)
+        return (armies, -1, full_hash(armies), land, plan)
+
+    def frontier_distance(self, armies, start):
+        '''Steps from |start| to the nearest unowned tile other than |start|, or the tile count if there is none.'''
+        distances = {start: 0}
+        spots_to_check = deque([start])
+        while len(spots_to_check) > 0:
+            current = spots_to_check.popleft()
+            for new_spot in self.neighbors[current]:
+                if new_spot not in distances:
+                    if not armies[new_spot]:
+                        return distances[current] + 1
+                    distances[new_spot] = distances[current] + 1
+                    spots_to_check.append(new_spot)
+        return self.tile_count
+
+    def candidates(self, parent_idx, state):
+        '''
+        Scores are (land, army available for future clears). An army is only worth what's left of it
+        once it has walked to the nearest unowned tile, so piling armies far from the frontier
+        (e.g. in a dead end next to the capital) doesn't look like progress.
+        '''
+        armies, active, h, land, _ = state
+        capital = self.capital
+        frontier_distances = {}
+        def available(tile, army):
+            if tile not in frontier_distances:
+                frontier_distances[tile] = self.frontier_distance(armies, tile)
+            return max(0, army - 1 - frontier_distances[tile])
+        origins = []
+        if active != -1 and armies[active] > 1:
+            origins.append(active)
+        if active != capital and armies[capital] > 1:
+            origins.append(capital)
+        for origin in origins:
+            army = armies[origin]
+            moved_h = h ^ zobrist(origin, army) ^ zobrist(origin, 1)
+            for destination in self.neighbors[origin]:
+                dest_army = armies[destination]
+                new_army = dest_army + army - 1
+                child_h = moved_h ^ zobrist(destination, new_army)
+                if dest_army:
+                    child_h ^= zobrist(destination, dest_army)
+                capital_army = 1 if origin == capital else (new_army if destination == capital else armies[capital])
+                score = (land + (0 if dest_army else 1),
+                         available(capital, capital_army) + (0 if destination == capital else available(destination, new_army)))
+                yield (score, child_h, parent_idx, origin, destination)
+        yield ((land, available(capital, armies[capital])), h, parent_idx, -1, -1)
+
+    def materialize(self, parents, candidate, half_turn):
+        _, child_h, parent_idx, origin, destination = candidate
+        armies, _, h, land, plan = parents[parent_idx]
+        armies = armies[:]
+        if origin == -1:
+            active = -1
+        else:
+            land += apply_move(armies, origin, destination)
+            active = destination
+            plan = ((half_turn, origin, destination), plan)
+            h = child_h
+        capital_army = armies[self.capital]
+        if apply_growth(armies, self.capital, half_turn):
+            h = full_hash(armies)
+        elif armies[self.capital] != capital_army:
+            h ^= zobrist(self.capital, capital_army) ^ zobrist(self.capital, armies[self.capital])
+        return (armies, active, h, land, plan)
+
+    def run(self, opening=(), progress=None):
+        beam = [self.initial_state(opening)]
+        for half_turn in range(self.opening_end(opening) + 1, self.half_turns + 1):
+            best = {}
+            for parent_idx, state in enumerate(beam):
+                for candidate in self.candidates(parent_idx, state):
+                    key = (candidate[1], candidate[4])
+                    if key not in best or best[key][0] < candidate[0]:
+                        best[key] = candidate
+            survivors = heapq.nlargest(self.beam_width, best.values(), key=lambda c: c[0])
+            beam = [self.materialize(beam, candidate, half_turn) for candidate in survivors]
+            if progress is not None:
+                progress(half_turn, beam)
+        return max(beam, key=lambda s: (s[3], s[0][self.capital]))
+
+
+def unroll_plan(plan):
+    moves = []
+    while plan is not None:
+        moves.append(plan[0])
+        plan = plan[1]
+    return list(reversed(moves))
+
+
+def land_by_turn(capital, tile_count, moves, turns):
+    '''Replays |moves| and returns the land owned at the end of every turn (index 0 = turn 0).'''
+    armies = array('H', [0] * tile_count)
+    armies[capital] = 1
+    moves_by_half_turn = {half_turn: (start, end) for half_turn, start, end in moves}
+    land = 1
+    curve = [land]
+    for half_turn in range(2, turns * 2 + 1):
+        if half_turn in moves_by_half_turn:
+            land += apply_move(armies, *moves_by_half_turn[half_turn])
+        apply_growth(armies, capital, half_turn)
+        if half_turn % 2 == 0:
+            curve.append(land)
+    return curve
+
+
+def to_clears(moves):
+    '''Groups consecutive moves into clears in the format returned by plan_optimal_moveset.'''
+    clears = []
+    for half_turn, start, end in moves:
+        if len(clears) and clears[-1]['path'][-1] == start and clears[-1]['last_half_turn'] == half_turn - 1:
+            clears[-1]['path'].append(end)
+            clears[-1]['last_half_turn'] = half_turn
+        else:
+            clears.append({'turn': half_turn // 2, 'half_turn': half_turn, 'last_half_turn': half_turn, 'path': [start, end]})
+    for clear in clears:
+        del clear['last_half_turn']
+    return clears
+
+
+def optimize_map(seed, turns, beam_width, map_options):
+    start_time = time()
+    world = generate_map(seed, **map_options)
+    # The opening search breaks ties randomly; seed it so a map's plan is reproducible
+    random.seed(seed)
+    opening = OpeningPlanner(world).plan_optimal_moveset()
+    search = BeamSearch(world, turns, beam_width)
+    best = search.run(opening)
+    moves = unroll_plan(best[4])
+    curve = land_by_turn(world.capital_location(), search.tile_count, moves, turns)
+    opening_land = 1 + len({step for clear in opening for step in clear['path'][1:]})
+    if turns >= OPENING_TURNS and curve[OPENING_TURNS] < opening_land:
+        print(f'Map {seed}: replayed opening owns {curve[OPENING_TURNS]} land by turn {OPENING_TURNS}; the live search planned {opening_land}')
+    return {
+        'seed': seed,
+        'map_width': world.map_width,
+        'map_height': world.map_height,
+        'terrain': world.terrain,
+        'capital': world.capital_location(),
+        'turns': turns,
+        'beam_width': beam_width,
+        'opening_land': opening_land,
+        'land_by_turn': curve,
+        'plan': to_clears(moves),
+        'seconds': round(time() - start_time, 1),
+    }
+
+
+def result_path(out_dir, seed):
+    return os.path.join(out_dir, f'map_{seed}.json')
+
+
+def save_result(out_dir, result):
+    # Write then rename so an interrupted run never leaves a partial checkpoint behind
+    file_name = result_path(out_dir, result['seed'])
+    with open(file_name + '.tmp', 'w') as result_file:
+        json.dump(result, result_file)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def save_summary(out_dir, seeds, turns):
+    checkpoints = [t for t in (25, 50, 75, 100, 125, 150) if t <= turns]
+    with open(os.path.join(out_dir, 'summary.csv'), 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['seed', 'map_width', 'map_height', *[f'land_turn_{t}' for t in checkpoints], 'clears', 'seconds'])
+        for seed in seeds:
+            if not os.path.exists(result_path(out_dir, seed)):
+                continue
+            with open(result_path(out_dir, seed)) as result_file:
+                result = json.load(result_file)
+            curve = result['land_by_turn']
+            writer.writerow([seed, result['map_width'], result['map_height'],
+                             *[curve[t] if t < len(curve) else '' for t in checkpoints],
+                             len(result['plan']), result['seconds']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search generated maps offline for the best expansion plans.')
+    parser.add_argument('--maps', type=int, default=32, help='number of maps in the corpus')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first map; map k uses seed + k')
+    parser.add_argument('--turns', type=int, default=MAX_TURNS, help=f'search horizon in turns (at most {MAX_TURNS})')
+    parser.add_argument('--beam-width', type=int, default=2000, help='states kept per half-turn')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: cpu count)')
+    parser.add_argument('--min-size', type=int, default=18)
+    parser.add_argument('--max-size', type=int, default=23)
+    parser.add_argument('--mountain-density', type=float, default=0.2)
+    parser.add_argument('--out', default='./solutions/offline', help='checkpoint and output directory')
+    args = parser.parse_args()
+    if not 1 <= args.turns <= MAX_TURNS:
+        parser.error(f'--turns must be between 1 and {MAX_TURNS}')
+
+    os.makedirs(args.out, exist_ok=True)
+    seeds = list(range(args.seed, args.seed + args.maps))
+    pending = [seed for seed in seeds if not os.path.exists(result_path(args.out, seed))]
+    print(f'{len(seeds) - len(pending)} of {len(seeds)} maps already solved in {args.out}.')
+    map_options = {'min_size': args.min_size, 'max_size': args.max_size, 'mountain_density': args.mountain_density}
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(optimize_map, seed, args.turns, args.beam_width, map_options): seed for seed in pending}
+        for future in as_completed(futures):
+            result = future.result()
+            save_result(args.out, result)
+            print(f'Map {result["seed"]} ({result["map_width"]}x{result["map_height"]}): '
+                  f'{result["land_by_turn"][-1]} land by turn {args.turns} in {result["seconds"]}s')
+
+    save_summary(args.out, seeds, args.turns)
+    print(f'Summary written to {os.path.join(args.out, "summary.csv")}')
+
+
+if __name__ == '__main__':
+    main()